@@ -1,19 +1,75 @@
 import subprocess
 import tempfile
-from decimal import Decimal
-from concurrent.futures import ThreadPoolExecutor
+import time
+from contextlib import contextmanager
+from fractions import Fraction
 from utils.video import *
+from utils.temp import get_temp_dir
 from typing import Tuple
-import shutil
+
+
+def _threads_options() -> list:
+    """
+    -threads for the render when the CYCLIPS_FFMPEG_THREADS environment variable sets it,
+    otherwise none, leaving ffmpeg and the encoder to pick their own thread counts.
+    A value that isn't a positive integer is ignored with a warning.
+    """
+    threads = os.environ.get("CYCLIPS_FFMPEG_THREADS", "").strip()
+    if not threads:
+        return []
+    if not threads.isdigit() or int(threads) < 1:
+        print(f"Ignoring CYCLIPS_FFMPEG_THREADS={threads!r}: expected a positive integer")
+        return []
+    return ["-threads", str(int(threads))]
+
+class _ProcessOutput:
+    """
+    Readable stdout of a process that raises at EOF when the process failed, so a consumer
+    reading until EOF, like an upload, aborts instead of committing truncated output.
+    """
+    def __init__(self, process: subprocess.Popen, stderr_tail):
+        self.process = process
+        self.stderr_tail = stderr_tail
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.process.stdout.read(size)
+        if not data and size != 0 and self.process.wait() != 0:
+            raise RuntimeError(f"Error rendering scenes: {self.stderr_tail()}")
+        return data
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
 
 class Exporter:
+    # Progress is only forwarded when it moved by this many points or this many seconds passed
+    PROGRESS_MIN_STEP = 5
+    PROGRESS_MIN_INTERVAL = 1.0
+
     def __init__(self, progress_callback=None):
         self.progress_callback = progress_callback
+        self.last_progress = None
+        self.last_progress_time = 0.0
         self.cookies_path: str = os.path.join(os.path.abspath(os.path.dirname(__file__)), "cookies.txt")
     
     def _update_progress(self, progress, message):
-        if self.progress_callback:
-            self.progress_callback(progress, message)
+        if not self.progress_callback:
+            return
+
+        now = time.monotonic()
+        if (
+            self.last_progress is not None
+            and progress < 100
+            and progress - self.last_progress < self.PROGRESS_MIN_STEP
+            and now - self.last_progress_time < self.PROGRESS_MIN_INTERVAL
+        ):
+            return
+
+        self.last_progress = progress
+        self.last_progress_time = now
+        self.progress_callback(progress, message)
             
     def export(
         self, 
@@ -23,159 +79,142 @@ class Exporter:
         scenes_path: str,
         output_path: str,
         aspect_ratio: Tuple[str, str] = (9, 16),
-        subtitles_path: str = None
+        subtitles_path: str = None,
+        metadata: dict = None
     ):
-        start = Decimal(str(start))
-        end = Decimal(str(end))
-        duration = end - start
+        with tempfile.TemporaryDirectory(dir=get_temp_dir()) as temp_dir:
+            command = self._build_command(video_url, start, end, scenes_path, aspect_ratio, subtitles_path, metadata, temp_dir)
+            command.extend(["-movflags", "+faststart", output_path])
 
-        with tempfile.TemporaryDirectory() as temp_dir:
-            self._update_progress(10, "Trimming the video...")
-            trimmed_clip_path = f"{temp_dir}/trimmed_clip.mp4"
-            
-            trim_video(video_path=video_url, output_path=trimmed_clip_path, start=start, end=end)
-
-            metadata = fetch_video_metadata(trimmed_clip_path)
-            video_width = int(metadata["streams"][0]["width"])
-            video_height = int(metadata["streams"][0]["height"])
-            video_fps = Decimal(eval(metadata["streams"][0]["avg_frame_rate"]))
-            min_frame_duration = Decimal(1) / video_fps 
-            
-            audio_path = f"{temp_dir}/audio.aac" if duration > min_frame_duration else None
-            if audio_path:
-                self._update_progress(20, "Extracting audio...")
-                extract_audio(trimmed_clip_path, audio_path)
-                                            
-            # Process scenes
-            self._update_progress(30, "Processing scenes...")
-            scenes = self._get_scenes(start, end, scenes_path, reset=True)
-            scene_paths = [f"{temp_dir}/scene_{i}.mp4" for i, _ in enumerate(scenes)]
-            with ThreadPoolExecutor() as executor:
-                executor.map(
-                    self._create_scene,
-                    scenes,
-                    [trimmed_clip_path] * len(scenes), 
-                    [video_width] * len(scenes), 
-                    [video_height] * len(scenes), 
-                    [video_fps] * len(scenes), 
-                    [aspect_ratio] * len(scenes), 
-                    scene_paths 
-                )
-
-            # Concatenate scenes
-            self._update_progress(50, "Concatenating scenes...")
-            concat_file_path = f"{temp_dir}/concat_list.txt"
-            with open(concat_file_path, 'w') as concat_file:
-                for scene_path in scene_paths:
-                    concat_file.write(f"file '{scene_path}'\n")
-
-            concatenated_clip_path = f"{temp_dir}/concatenated_clip.mp4"
-            self._concatenate_videos(concatenated_clip_path, concat_file_path, audio_path=audio_path)
-
-            if subtitles_path: 
-                self._update_progress(90, "Attaching subtitles...")
-                attach_subtitles(concatenated_clip_path, subtitles_path, output_path)
-            else:
-                shutil.copy(concatenated_clip_path, output_path)
+            self._update_progress(30, "Rendering scenes...")
+            run_ffmpeg(command, "Error rendering scenes", env={**os.environ, "TMPDIR": temp_dir})
                 
         self._update_progress(100, "Export completed successfully!")
 
-    def _create_scene(
+    @contextmanager
+    def export_stream(
         self,
-        scene: dict,
-        video_path: str,
-        video_width: int,
-        video_height: int,
-        video_fps: Decimal,
-        aspect_ratio: Tuple[str, str],
-        output_path: str
+        video_url: str,
+        start: float,
+        end: float,
+        scenes_path: str,
+        aspect_ratio: Tuple[str, str] = (9, 16),
+        subtitles_path: str = None,
+        metadata: dict = None
     ):
-        scene_start = scene["start_time"]
-        scene_end = scene["end_time"]
-
-        with tempfile.TemporaryDirectory() as temp_dir:
-            segment_path = f"{temp_dir}/segment.mp4"
-            trim_video(
-                video_path=video_path, 
-                output_path=segment_path, 
-                start=scene_start, 
-                end=scene_end, 
-                fps=video_fps,
-                no_audio=True
+        """
+        Same as export, but yields ffmpeg's stdout as a readable stream of fragmented mp4
+        instead of writing a file. The stream must be consumed inside the context; reading
+        it to EOF raises if ffmpeg failed, before the consumer can treat the output as complete.
+        """
+        with tempfile.TemporaryDirectory(dir=get_temp_dir()) as temp_dir:
+            command = self._build_command(video_url, start, end, scenes_path, aspect_ratio, subtitles_path, metadata, temp_dir)
+            command.extend(["-movflags", "frag_keyframe+empty_moov", "-f", "mp4", "pipe:1"])
+
+            self._update_progress(30, "Rendering scenes...")
+            process, stderr_tail = start_ffmpeg(
+                command,
+                env={**os.environ, "TMPDIR": temp_dir},
+                stdout=subprocess.PIPE
             )
 
-            if scene["type"] == "fill":
-                apply_fill(
-                    scene=scene, 
-                    input_path=segment_path, 
-                    output_path=output_path,
-                    video_height=video_height,
-                    video_width=video_width,
-                    )
-            elif scene["type"] == "fit":
-                
-                apply_fit(
-                    input_path=segment_path, 
-                    output_path=output_path,
-                    video_height=video_height,
-                    video_width=video_width,
-                    aspect_ratio=aspect_ratio
-                    )
-            else:
-                raise ValueError(f"Unknown scene type: {scene['type']}")
-
-    def _concatenate_videos(self, output_path:str, concat_file_path:str, audio_path: str = None):
+            try:
+                yield _ProcessOutput(process, stderr_tail)
+            except BaseException:
+                process.kill()
+                raise
+            finally:
+                process.stdout.close()
+                process.wait()
+
+            if process.returncode != 0:
+                raise RuntimeError(f"Error rendering scenes: {stderr_tail()}")
+
+        self._update_progress(100, "Export completed successfully!")
+
+    def _build_command(
+        self,
+        video_url: str,
+        start: float,
+        end: float,
+        scenes_path: str,
+        aspect_ratio: Tuple[str, str],
+        subtitles_path: str,
+        metadata: dict,
+        temp_dir: str
+    ) -> list:
+        """
+        Builds the ffmpeg command rendering the export, without its output. The filter graph
+        is written to a script in `temp_dir` so its length isn't bound by the argument size limit.
+        """
+        start = to_microseconds(start)
+        end = to_microseconds(end)
+        duration = end - start
+        if duration <= 0:
+            raise ValueError("End time must be greater than start time.")
+
+        if metadata is None:
+            self._update_progress(10, "Fetching video metadata...")
+            metadata = fetch_video_metadata(video_url)
+        video_stream = next(stream for stream in metadata["streams"] if stream["codec_type"] == "video")
+        video_width, video_height = display_size(video_stream)
+        video_fps = Fraction(video_stream["avg_frame_rate"])
+        min_frame_duration = 1_000_000 / video_fps
+
+        scenes = self._get_scenes(start, end, scenes_path, reset=True)
+        if not scenes:
+            raise ValueError("No scenes found between the start and end times.")
+
+        fonts_dir = extract_subtitles_font(subtitles_path) if subtitles_path else None
+        filter_graph = render_scenes_filter(scenes, video_width, video_height, aspect_ratio, subtitles_path, fonts_dir)
+        filter_script_path = os.path.join(temp_dir, "graph.ffg")
+        with open(filter_script_path, "w") as file:
+            file.write(filter_graph)
+
+        threads_args = _threads_options()
         command = [
-            "ffmpeg",
+            FFMPEG,
             "-y",
-            "-f", "concat",
-            "-safe", "0",
-            "-i", concat_file_path,
+            "-ss", format_microseconds(start),
+            "-t", format_microseconds(duration),
+            *threads_args,
+            *decoder_options(),
+            *input_options(video_url),
+            "-i", video_url,
+            *threads_args,
+            "-filter_complex_script", filter_script_path,
+            "-map", "[vout]",
         ]
 
-        if audio_path:
-            command.extend(["-i", audio_path])
+        if duration > min_frame_duration:
+            command.extend(["-map", "0:a?", "-c:a", "copy", "-shortest"])
 
-        command.extend([
-            "-shortest",
-            "-c:v", "libx264",
-            "-crf", "17",
-            output_path,
-        ])
+        command.extend(encoder_options(17, preset="medium"))
         
-        result = subprocess.run(
-            command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            check=True,  
-            text=True  
-        )
-        if result.returncode != 0:
-            raise RuntimeError(f"Error concatenating segments: {result.stderr}")
-
-    def _get_scenes(self, start: Decimal, end: Decimal, scenes_path: str, reset: bool = True):
+        return command
+
+    def _get_scenes(self, start: int, end: int, scenes_path: str, reset: bool = True):
         with open(scenes_path, "r") as file:
             all_scenes = json.load(file)
 
-        filtered_boxes = [
-            scene for scene in all_scenes
-            if not (scene["end_time"] < start or scene["start_time"] > end) 
-        ]
-        filtered_boxes = [ 
-            {
-                **scene, 
-                "start_time": Decimal(str(scene["start_time"])), 
-                "end_time": Decimal(str(scene["end_time"]))
-            } for scene in filtered_boxes ]
+        # Scene times are converted to integer microseconds, like start and end. Scenes that
+        # only touch the range at one of its ends would be empty once rebased, so they are skipped
+        filtered_boxes = []
+        for scene in all_scenes:
+            scene_start = to_microseconds(scene["start_time"])
+            scene_end = to_microseconds(scene["end_time"])
+            if scene_end <= max(start, scene_start) or scene_start >= end:
+                continue
+            filtered_boxes.append({**scene, "start_time": scene_start, "end_time": scene_end})
 
         if reset and filtered_boxes:
             time_offset = start
 
             for box in filtered_boxes:
-                box["start_time"] = max(box["start_time"] - time_offset, Decimal(0))
-                box["end_time"] = max(box["end_time"] - time_offset, Decimal(0))
+                box["start_time"] = max(box["start_time"] - time_offset, 0)
+                box["end_time"] = max(box["end_time"] - time_offset, 0)
 
-            filtered_boxes[0]["start_time"] = Decimal(0)
+            filtered_boxes[0]["start_time"] = 0
             filtered_boxes[-1]["end_time"] = end - start
 
         return filtered_boxes
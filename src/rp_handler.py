@@ -7,8 +7,11 @@ rp_debugger:
 """
 
 import base64
+import binascii
+import re
 import tempfile
 import os
+from concurrent.futures import ThreadPoolExecutor, wait, ALL_COMPLETED
 from typing import Optional
 
 from dotenv import load_dotenv
@@ -18,37 +21,50 @@ import runpod
 
 from rp_schema import INPUT_VALIDATIONS
 from export import Exporter
-from utils.azure import upload_file
+from utils.azure import upload_stream
+from utils.video import fetch_video_metadata
+from utils.temp import get_temp_dir
 
 load_dotenv()
 
 
+BASE64_PATTERN = re.compile(r"[A-Za-z0-9+/]*={0,2}")
+
+
 def is_valid_base64(data: Optional[str]) -> bool:
     """
-    Check if a string is valid base64.
+    Check if a string is valid base64, without decoding it.
     """
     if not data:
         return True
-    try:
-        base64.b64decode(data, validate=True)
-        return True
-    except Exception:
-        return False
+    return len(data) % 4 == 0 and BASE64_PATTERN.fullmatch(data) is not None
 
 
-def base64_to_tempfile(base64_file: str) -> str:
+def base64_to_tempfile(base64_file: str, dir: Optional[str] = None) -> str:
     """
     Convert base64-encoded string to a temporary file.
 
     Parameters:
         base64_file (str): Base64-encoded string.
+        dir (str): Directory to create the file in, the default temporary directory if None.
 
     Returns:
         str: Path to the created temporary file.
+
+    Raises:
+        ValueError: If the string is not valid base64.
     """
-    with tempfile.NamedTemporaryFile(suffix=".ass", delete=False) as temp_file:
-        temp_file.write(base64.b64decode(base64_file))
-    return temp_file.name
+    try:
+        decoded = base64.b64decode(base64_file)
+    except binascii.Error as e:
+        raise ValueError(f"Invalid base64 data: {e}")
+
+    fd, path = tempfile.mkstemp(suffix=".ass", dir=dir)
+    try:
+        os.write(fd, decoded)
+    finally:
+        os.close(fd)
+    return path
 
 @rp_debugger.FunctionTimer
 def handler(job: dict):
@@ -72,23 +88,30 @@ def handler(job: dict):
                 }
                 runpod.serverless.progress_update(job, status_data)
 
-            subtitles_path = base64_to_tempfile(job_input["subtitles"]) if job_input["subtitles"] else None
+            # Job scratch files are removed once the export is uploaded
+            with tempfile.TemporaryDirectory(dir=get_temp_dir(len(job_input["subtitles"]))) as temp_dir:
+                subtitles_path = base64_to_tempfile(job_input["subtitles"], temp_dir) if job_input["subtitles"] else None
 
-            with rp_debugger.LineTimer(f"download_step"):
-                scenes_path = download_files_from_urls(job["id"], [job_input["scenes_url"]])[0]
+                with rp_debugger.LineTimer(f"download_step"):
+                    # Probe the video while the scenes are downloading
+                    with ThreadPoolExecutor(max_workers=2) as executor:
+                        scenes_future = executor.submit(download_files_from_urls, job["id"], [job_input["scenes_url"]])
+                        metadata_future = executor.submit(fetch_video_metadata, job_input["video_url"])
+                        wait([scenes_future, metadata_future], return_when=ALL_COMPLETED)
 
-            with rp_debugger.LineTimer(f"export_step"):
-                with tempfile.NamedTemporaryFile(suffix=".mp4") as temp_file:
-                    Exporter(progress_callback=progress_callback).export(
+                    scenes_path = scenes_future.result()[0]
+                    metadata = metadata_future.result()
+
+                with rp_debugger.LineTimer(f"export_step"):
+                    with Exporter(progress_callback=progress_callback).export_stream(
                         video_url=job_input["video_url"],
                         start=job_input["start"],
                         end=job_input["end"],
                         scenes_path=scenes_path,
                         subtitles_path=subtitles_path,
-                        output_path=temp_file.name
-                    )
-
-                    upload_file(job_input["destination_url"], temp_file.name)
+                        metadata=metadata
+                    ) as stream:
+                        upload_stream(job_input["destination_url"], stream)
 
             return {"status": "completed"}
 
@@ -1,45 +1,100 @@
 import os
+import functools
+import threading
+from azure.core.exceptions import ResourceExistsError
+from azure.core.pipeline.transport import RequestsTransport
 from azure.storage.blob import BlobServiceClient
+from requests import Session
+from requests.adapters import HTTPAdapter
 from urllib.parse import urlparse
 import logging
+from typing import BinaryIO
 
 logger = logging.getLogger("logger_name")
 logger.disabled = True
 
-def upload_file(destination_url: str, file_path: str):
+# Containers known to exist, so uploads skip the create_container round trip
+_existing_containers = set()
+_existing_containers_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=1)
+def get_blob_service_client(connection_string: str) -> BlobServiceClient:
+    """
+    Returns a BlobServiceClient shared across uploads, so warm handler invocations
+    reuse its pooled keep-alive connections instead of handshaking again.
+
+    Args:
+        connection_string (str): The Azure Storage connection string.
+    """
+    session = Session()
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    transport = RequestsTransport(session=session, session_owner=False)
+    return BlobServiceClient.from_connection_string(connection_string, logger=logger, transport=transport)
+
+def _get_blob_client(destination_url: str):
     """
-    Uploads a file to Azure Blob Storage using a destination URL.
+    Creates a blob client for the destination URL, creating its container if needed.
 
     Args:
         destination_url (str): The URL of the blob in Azure Blob Storage.
-        file_path (str): The local file path to upload.
     """
     azure_storage_key = os.environ.get("AZURE_STORAGE_CONNECTION_STRING")
     
     if not azure_storage_key:
         raise ValueError("Environment variable 'AZURE_STORAGE_CONNECTION_STRING' is not set or empty.")
     
-    try:
-        parsed_url = urlparse(destination_url)
-        path_segments = parsed_url.path.lstrip("/").split("/")
-        container_name = path_segments[0]
-        blob_name = "/".join(path_segments[1:])
-        
-        blob_service_client = BlobServiceClient.from_connection_string(azure_storage_key, logger=logger)
+    parsed_url = urlparse(destination_url)
+    path_segments = parsed_url.path.lstrip("/").split("/")
+    container_name = path_segments[0]
+    blob_name = "/".join(path_segments[1:])
+    
+    blob_service_client = get_blob_service_client(azure_storage_key)
 
+    container_key = (blob_service_client.account_name, container_name)
+    with _existing_containers_lock:
+        container_exists = container_key in _existing_containers
+
+    if not container_exists:
         try:
             container_client = blob_service_client.create_container(container_name)
             logger.info(f"Container '{container_name}' created.")
+            container_exists = True
+        except ResourceExistsError:
+            container_exists = True
         except Exception as e:
-            logger.warning(f"Container creation failed or already exists: {e}")
-        
-        blob_client = blob_service_client.get_blob_client(container=container_name, blob=blob_name)
+            logger.warning(f"Container creation failed: {e}")
+
+        if container_exists:
+            with _existing_containers_lock:
+                _existing_containers.add(container_key)
+    
+    return blob_service_client.get_blob_client(container=container_name, blob=blob_name)
+
+def upload_stream(destination_url: str, stream: BinaryIO):
+    """
+    Uploads a readable stream of unknown length, such as a process' stdout, to Azure Blob Storage.
 
-        with open(file_path, "rb") as data:
-            blob_client.upload_blob(data=data, blob_type="BlockBlob", overwrite=True, max_concurrency=5, connection_timeout=600)
+    Args:
+        destination_url (str): The URL of the blob in Azure Blob Storage.
+        stream (BinaryIO): The stream to upload, read until EOF. If reading raises, the upload
+            is aborted before the blob is committed.
+    """
+    try:
+        blob_client = _get_blob_client(destination_url)
+        blob_client.upload_blob(
+            data=stream,
+            blob_type="BlockBlob",
+            overwrite=True,
+            max_concurrency=8,
+            validate_content=False,
+            connection_timeout=600
+        )
         
-        print(f"File uploaded successfully to {destination_url}")
+        print(f"Stream uploaded successfully to {destination_url}")
 
     except Exception as e:
-        logger.error(f"Failed to upload file to {destination_url}: {e}")
+        logger.error(f"Failed to upload stream to {destination_url}: {e}")
         raise
@@ -0,0 +1,24 @@
+import os
+import shutil
+
+SHM_PATH = "/dev/shm"
+
+def get_temp_dir(required_bytes: int = 0):
+    """
+    Returns a RAM-backed (tmpfs) directory to create short-lived files in, or None to use
+    the default temporary directory.
+
+    Args:
+        required_bytes (int): Estimated size of the files to write. /dev/shm is only used
+            when it has at least twice this much free space.
+
+    Returns:
+        str: Path to /dev/shm, or None if it is unavailable or too small.
+    """
+    if not os.path.isdir(SHM_PATH) or not os.access(SHM_PATH, os.W_OK):
+        return None
+
+    if shutil.disk_usage(SHM_PATH).free < required_bytes * 2:
+        return None
+
+    return SHM_PATH
@@ -1,28 +1,200 @@
 import subprocess
 import json
-from decimal import Decimal
 from typing import Tuple
 import tempfile
 import base64
 import re
 import os
+import copy
+import functools
+import hashlib
+import shutil
+import threading
+import urllib.request
+
+def to_microseconds(seconds: float) -> int:
+    """
+    Converts a time in seconds to integer microseconds.
+    """
+    return int(round(seconds * 1_000_000))
+
+def format_microseconds(microseconds: int) -> str:
+    """
+    Formats a time in integer microseconds as seconds for ffmpeg, e.g. 1500000 -> "1.500000".
+    """
+    seconds, remainder = divmod(microseconds, 1_000_000)
+    return f"{seconds}.{remainder:06d}"
+
+# Resolved once, so every spawn execs an absolute path instead of searching PATH
+FFMPEG = shutil.which("ffmpeg") or "ffmpeg"
+FFPROBE = shutil.which("ffprobe") or "ffprobe"
+
+# Fonts extracted from subtitles, one directory per embedded font
+FONTS_CACHE_DIR = os.path.join(tempfile.gettempdir(), "cyclips-fonts")
+FONT_DATA_PATTERN = re.compile(rb"data: (.+)")
+
+# Inputs are mp4 files with known codecs: cap stream probing and seek on the index
+FAST_OPEN = ["-probesize", "1000000", "-analyzeduration", "1000000", "-fflags", "+fastseek"]
+
+def reconnect_options(video_path: str) -> list:
+    """
+    Remote videos reconnect on dropped connections, so seeking with `-ss` before `-i`
+    only fetches the needed byte ranges.
+    """
+    if video_path.startswith(("http://", "https://")):
+        return ["-reconnect", "1", "-reconnect_streamed", "1", "-reconnect_delay_max", "5"]
+    return []
+
+def input_options(video_path: str) -> list:
+    """
+    Input options to place before every ffmpeg `-i video_path`.
+    """
+    return [*FAST_OPEN, *reconnect_options(video_path)]
+
+@functools.lru_cache(maxsize=1)
+def hardware_encoder():
+    """
+    Detects once whether ffmpeg can encode H.264 on an NVIDIA GPU. Builds list h264_nvenc
+    even without a GPU, so a few frames are actually encoded rather than grepping `-encoders`.
+    Set CYCLIPS_HW_ENCODER=0 to always encode on the CPU.
+
+    Returns:
+        str: "h264_nvenc" if available, None otherwise.
+    """
+    if os.environ.get("CYCLIPS_HW_ENCODER") == "0":
+        return None
+
+    command = [
+        FFMPEG,
+        "-v", "error",
+        "-f", "lavfi", "-i", "color=black:s=256x256:d=0.1",
+        "-c:v", "h264_nvenc",
+        "-f", "null", "-"
+    ]
+    try:
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=30)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+
+    return "h264_nvenc" if result.returncode == 0 else None
+
+def decoder_options() -> list:
+    """
+    Input options decoding on the GPU when it is also used for encoding. Frames are
+    downloaded to system memory for the CPU filters (scale, blur, ass).
+    """
+    return ["-hwaccel", "cuda"] if hardware_encoder() else []
+
+def encoder_options(crf: int, preset: str = None) -> list:
+    """
+    H.264 encoder options at the given constant quality: NVENC when available, libx264 otherwise.
+
+    Args:
+        crf (int): libx264 CRF. NVENC uses the roughly equivalent CQ of crf + 2.
+        preset (str): libx264 preset.
+    """
+    if hardware_encoder():
+        return ["-c:v", "h264_nvenc", "-preset", "p4", "-tune", "hq", "-rc", "vbr", "-cq", str(crf + 2), "-b:v", "0"]
+
+    options = ["-c:v", "libx264", "-crf", str(crf)]
+    if preset:
+        options.extend(["-preset", preset])
+    return options
+
+def start_ffmpeg(command: list, capture_tail: int = 4096, **popen_kwargs):
+    """
+    Starts ffmpeg with its stderr drained as bytes by a background thread that only keeps
+    the last `capture_tail` bytes, so long encodes don't accumulate their whole log in memory.
+
+    Args:
+        command (list): The ffmpeg command.
+        capture_tail (int): Number of stderr bytes to keep for error messages.
+        **popen_kwargs: Passed to subprocess.Popen, e.g. stdout or env.
+
+    Returns:
+        Tuple[subprocess.Popen, Callable[[], str]]: The process, and a function returning its stderr tail
+        once the process exited.
+    """
+    process = subprocess.Popen(command, stderr=subprocess.PIPE, **popen_kwargs)
+    tail = bytearray()
+
+    def drain():
+        for chunk in iter(lambda: process.stderr.read1(4096), b""):
+            tail.extend(chunk)
+            del tail[:-capture_tail]
+        process.stderr.close()
+
+    reader = threading.Thread(target=drain, daemon=True)
+    reader.start()
+
+    def stderr_tail() -> str:
+        reader.join()
+        return tail.decode(errors="replace")
+
+    return process, stderr_tail
+
+def run_ffmpeg(command: list, error_message: str, capture_tail: int = 4096, **popen_kwargs):
+    """
+    Runs ffmpeg to completion, raising a RuntimeError with the tail of its stderr if it fails.
+
+    Args:
+        command (list): The ffmpeg command.
+        error_message (str): Prefix of the error message.
+        capture_tail (int): Number of stderr bytes to keep for the error message.
+        **popen_kwargs: Passed to subprocess.Popen.
+    """
+    process, stderr_tail = start_ffmpeg(command, capture_tail, stdout=subprocess.DEVNULL, **popen_kwargs)
+    process.wait()
+
+    if process.returncode != 0:
+        raise RuntimeError(f"{error_message}: {stderr_tail()}")
 
 def fetch_video_metadata(video_path: str):
     """
-    Fetches video metadata using ffprobe.
+    Fetches video metadata using ffprobe. Results are cached for as long as the
+    video is unchanged, so probing the same source again skips ffprobe.
 
     Args:
-        video_path (str): Path to the video file.
+        video_path (str): Path or URL of the video file.
 
     Returns:
         dict: Dictionary containing video metadata.
     """
+    cache_key = _metadata_cache_key(video_path)
+    if cache_key is None:
+        return _probe_video(video_path)
+    return copy.deepcopy(_probe_video_cached(video_path, cache_key))
+
+def _metadata_cache_key(video_path: str):
+    """
+    Identifies the current version of a local file (size, mtime) or URL (ETag, Content-Length).
+    Returns None when the video cannot be identified and must not be cached.
+    """
+    if os.path.exists(video_path):
+        stat = os.stat(video_path)
+        return (os.path.realpath(video_path), stat.st_size, stat.st_mtime_ns)
+
+    try:
+        request = urllib.request.Request(video_path, method="HEAD")
+        with urllib.request.urlopen(request, timeout=10) as response:
+            validator = response.headers.get("ETag") or response.headers.get("Content-Length")
+    except Exception:
+        return None
+
+    return (video_path, validator) if validator else None
+
+@functools.lru_cache(maxsize=128)
+def _probe_video_cached(video_path: str, cache_key: tuple):
+    return _probe_video(video_path)
+
+def _probe_video(video_path: str):
     command = [
-        "ffprobe",
+        FFPROBE,
         "-v", "error",              
         "-print_format", "json",  
         "-show_format",            
         "-show_streams",           
+        *reconnect_options(video_path),
         video_path
     ]
 
@@ -30,7 +202,6 @@ def fetch_video_metadata(video_path: str):
         command,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
-        check=True,
         text=True
     )
 
@@ -40,103 +211,26 @@ def fetch_video_metadata(video_path: str):
     metadata = json.loads(result.stdout)
     return metadata
 
-def trim_video(
-    video_path: str, 
-    output_path: str, 
-    start: Decimal, 
-    end: Decimal,
-    fps: Decimal = None,
-    no_audio: bool = False  
-):
+def display_size(video_stream: dict) -> Tuple[int, int]:
     """
-    Trims a video file to the specified start and end times.
-
-    Args:
-        video_path (str): Path to the input video.
-        output_path (str): Path to save the trimmed video.
-        start (Decimal): Start time in seconds as a Decimal.
-        end (Decimal): End time in seconds as a Decimal.
-        no_audio (bool): Whether to remove audio from the trimmed video.
-    """
-    duration = end - start
-    if duration <= 0:
-        raise ValueError("End time must be greater than start time.")
-    
-    frame_duration = Decimal(1/fps) if fps else 0
-    if duration <= frame_duration:
-        command = [
-            "ffmpeg",
-            "-y",  
-            "-i", video_path, 
-            "-ss", f"{start:.6f}",
-            "-vf", f"select='eq(n,0)',setpts=PTS-STARTPTS",  
-            "-frames:v", "1",
-            "-c:v", "libx264", 
-            "-crf", "18",
-            "-an"
-        ]
-    else:
-        command = [
-            "ffmpeg",
-            "-y", 
-            "-ss", f"{start:.6f}",
-            "-i", video_path,
-            "-t", f"{duration:.6f}",
-            "-c:v", "libx264",  
-            "-crf", "18",  
-            "-preset", "ultrafast",
-            "-c:a", "copy",  
-        ]
-    
-    if no_audio:
-        command.extend(["-an"])
-        
-    command.extend([output_path])
-
-    result = subprocess.run(
-        command,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        check=True,  
-        text=True  
-    )
-    
-    if result.returncode != 0:
-        raise RuntimeError(f"Error trimming video: {result.stderr}")
-    
-def extract_audio(
-    video_path: str, 
-    output_path: str, 
-):
+    Width and height of an ffprobe video stream as ffmpeg outputs its frames: ffmpeg autorotates
+    frames with a display matrix, so the coded size is swapped for 90 and 270 degree rotations.
     """
-    Extracts audio from a video file and saves it to the specified output file.
+    width = int(video_stream["width"])
+    height = int(video_stream["height"])
 
-    Args:
-        video_path (str): Path to the input video.
-        output_path (str): Path to save the extracted audio.
-    """
-    command = [
-        "ffmpeg",
-        "-y", 
-        "-i", video_path,
-        "-vn", 
-        output_path
-    ]
+    rotation = video_stream.get("tags", {}).get("rotate", 0)
+    for side_data in video_stream.get("side_data_list", []):
+        if "rotation" in side_data:
+            rotation = side_data["rotation"]
 
-    result = subprocess.run(
-        command,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        check=True,  
-        text=True  
-    )
-    
-    if result.returncode != 0:
-        raise RuntimeError(f"Error extracting audio: {result.stderr}")
-    
-def apply_fit(input_path: str, output_path: str, video_width: float, video_height: float, aspect_ratio: Tuple[str, str]):
+    if round(float(rotation)) % 180 == 90:
+        return height, width
+    return width, height
+
+def fit_size(video_width: float, video_height: float, aspect_ratio: Tuple[str, str]) -> Tuple[int, int]:
     """
-    Create a background frosted glass effect with blurred edges for a video segment.
+    Computes the output dimensions of a fit layout for the given aspect ratio.
     """
     aspect_ratio_width, aspect_ratio_height = aspect_ratio
     if video_width / video_height > aspect_ratio_width / aspect_ratio_height:
@@ -146,133 +240,163 @@ def apply_fit(input_path: str, output_path: str, video_width: float, video_heigh
         output_width = video_width
         output_height = video_width * (aspect_ratio_height / aspect_ratio_width)
 
-    output_width = round(output_width / 2) * 2
-    output_height = round(output_height / 2) * 2
+    return round(output_width / 2) * 2, round(output_height / 2) * 2
 
-    command = [
-        'ffmpeg', '-y', '-i', input_path, '-i', input_path,
-        '-filter_complex', (
-            f"[0:v]scale={video_width}:{video_height},gblur=sigma=10,crop={output_width}:{output_height},"
-            f"setsar=1/1[b];"
-            f"[1:v]scale={output_width}:-2,setsar=1[f];"
-            f"[b][f]overlay=(W-w)/2:(H-h)/2:enable=1,format=rgba,colorchannelmixer=aa=0.9"
-        ),
-        '-c:v', 'libx264', "-preset", "ultrafast",'-crf', '17', '-an', output_path
-    ]
+def fill_size(scene: dict, video_width: float, video_height: float) -> Tuple[int, int]:
+    """
+    Computes the output dimensions of a fill layout from the scene's crop_width and crop_height.
+    """
+    crop_width = scene['crop_width'] * video_width
+    crop_height = scene['crop_height'] * video_height
 
-    result = subprocess.run(
-        command,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        check=True,  
-        text=True  
+    return round(crop_width / 2) * 2, round(crop_height / 2) * 2
+
+def apply_fit(input_label: str, output_label: str, video_width: float, video_height: float, aspect_ratio: Tuple[str, str]) -> str:
+    """
+    Builds the filter graph creating a background frosted glass effect with blurred edges.
+
+    Args:
+        input_label (str): Label of the video stream to read from.
+        output_label (str): Label of the resulting video stream.
+
+    Returns:
+        str: Filter graph reading [input_label] and producing [output_label].
+    """
+    output_width, output_height = fit_size(video_width, video_height, aspect_ratio)
+
+    # The video already has the aspect ratio: the foreground would cover the whole background
+    if (output_width, output_height) == (video_width, video_height):
+        return f"[{input_label}]setsar=1[{output_label}]"
+
+    # A box blur looks the same behind the foreground at a fraction of gblur's cost; CYCLIPS_HQ_BLUR=1 restores gblur
+    blur = "gblur=sigma=10" if os.environ.get("CYCLIPS_HQ_BLUR") == "1" else "boxblur=luma_radius=8:luma_power=3"
+
+    return (
+        f"[{input_label}]split=2[{output_label}_b][{output_label}_f];"
+        f"[{output_label}_b]scale={video_width}:{video_height},{blur},crop={output_width}:{output_height},"
+        f"setsar=1/1[{output_label}_bg];"
+        f"[{output_label}_f]scale={output_width}:-2,setsar=1[{output_label}_fg];"
+        f"[{output_label}_bg][{output_label}_fg]overlay=(W-w)/2:(H-h)/2:enable=1,format=rgba,colorchannelmixer=aa=0.9"
+        f"[{output_label}]"
     )
-    
-    if result.returncode != 0:
-        raise RuntimeError(f"Error applying fit layout: {result.stderr}")
             
-def apply_fill(scene: dict, input_path:str, output_path:str, video_width: float, video_height: float):
+def apply_fill(scene: dict, input_label: str, output_label: str, video_width: float, video_height: float) -> str:
     """
-    Apply a bounding box effect to a video segment using crop_width and crop_height from the scene.
+    Builds the filter graph applying a bounding box effect using crop_width and crop_height from the scene.
+
+    Args:
+        input_label (str): Label of the video stream to read from.
+        output_label (str): Label of the resulting video stream.
+
+    Returns:
+        str: Filter graph reading [input_label] and producing [output_label].
     """
-    
     top_left_x, top_left_y = scene['top_left']
     
     top_left_x = top_left_x * video_width
     top_left_y = top_left_y * video_height
 
-    crop_width = scene['crop_width'] * video_width
-    crop_height = scene['crop_height'] * video_height
-    
-    output_width = round(crop_width / 2) * 2
-    output_height = round(crop_height / 2) * 2
+    output_width, output_height = fill_size(scene, video_width, video_height)
 
-    command = [
-        'ffmpeg', '-y', '-ss', '0', '-i', input_path,
-        '-vf', f"scale=w={video_width}:h={video_height},setsar=1/1,crop=w={output_width}:h={output_height}:x={top_left_x}:y={top_left_y}",
-        "-preset", "ultrafast",'-c:v', 'libx264', '-crf', '17',
-        output_path
-    ]
+    # The box covers the whole video: nothing to crop
+    if (output_width, output_height) == (video_width, video_height) and abs(top_left_x) < 1 and abs(top_left_y) < 1:
+        return f"[{input_label}]setsar=1/1[{output_label}]"
 
-    result = subprocess.run(
-        command,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        check=True,  
-        text=True  
+    return (
+        f"[{input_label}]scale=w={video_width}:h={video_height},setsar=1/1,"
+        f"crop=w={output_width}:h={output_height}:x={top_left_x}:y={top_left_y}[{output_label}]"
     )
-    
-    if result.returncode != 0:
-        raise RuntimeError(f"Error applying fill layout: {result.stderr}")
         
-def attach_audio(video_path: str, audio_path: str, output_path: str):
+def render_scenes_filter(
+    scenes: list,
+    video_width: int,
+    video_height: int,
+    aspect_ratio: Tuple[str, str],
+    subtitles_path: str = None,
+    fonts_dir: str = None
+) -> str:
     """
-    Attaches an audio track to a video file and saves it to the specified output file.
+    Builds the filter graph rendering an export in a single pass: every scene is trimmed from
+    the input video and laid out, the scenes are concatenated and the subtitles burnt in.
 
     Args:
-        video_path (str): Path to the input video.
-        audio_path (str): Path to the input audio file.
-        output_path (str): Path to save the output video with attached audio.
+        scenes (list): Scenes with start_time and end_time in microseconds, relative to the input.
+        subtitles_path (str): Path to the .ass subtitles to burn in, if any.
+        fonts_dir (str): Directory containing the subtitles' font.
+
+    Returns:
+        str: Filter graph reading [0:v] and producing [vout].
     """
-    command = [
-        "ffmpeg",
-        "-y",  
-        "-i", video_path,
-        "-i", audio_path,
-        "-c:v", "copy",  
-        "-c:a", "copy",  
-        "-shortest", 
-        output_path
-    ]
+    filters = [f"[0:v]split={len(scenes)}" + "".join(f"[v{i}]" for i in range(len(scenes)))]
+    output_size = None
 
-    result = subprocess.run(
-        command,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        check=True,  
-        text=True  
-    )
-    
-    if result.returncode != 0:
-        raise RuntimeError(f"Error attaching audio: {result.stderr}")
-        
-def attach_subtitles(input_path: str, subtitles_path: str, output_path: str):
+    for i, scene in enumerate(scenes):
+        filters.append(
+            f"[v{i}]trim=start={format_microseconds(scene['start_time'])}:end={format_microseconds(scene['end_time'])},"
+            f"setpts=PTS-STARTPTS[t{i}]"
+        )
+
+        if scene["type"] == "fill":
+            filters.append(apply_fill(scene, f"t{i}", f"l{i}", video_width, video_height))
+            scene_size = fill_size(scene, video_width, video_height)
+        elif scene["type"] == "fit":
+            filters.append(apply_fit(f"t{i}", f"l{i}", video_width, video_height, aspect_ratio))
+            scene_size = fit_size(video_width, video_height, aspect_ratio)
+        else:
+            raise ValueError(f"Unknown scene type: {scene['type']}")
+
+        # Scenes are concatenated at the size of the first one
+        output_size = output_size or scene_size
+        scale = f"scale={output_size[0]}:{output_size[1]},setsar=1," if scene_size != output_size else ""
+        filters.append(f"[l{i}]{scale}format=yuv420p[s{i}]")
+
+    concat = "".join(f"[s{i}]" for i in range(len(scenes))) + f"concat=n={len(scenes)}:v=1:a=0"
+    if subtitles_path:
+        concat += "," + subtitles_filter(subtitles_path, fonts_dir)
+    filters.append(concat + "[vout]")
+
+    return ";".join(filters)
+
+def extract_subtitles_font(subtitles_path: str) -> str:
     """
-    Extract the Base64 font data from the .ass file, decode it, save it as a temporary file,
-    and use it to attach subtitles and the extracted font to the video using FFmpeg.
+    Extract the Base64 font data from the .ass file, decode it and save it in a directory
+    named after the data's SHA-1, so subtitles embedding the same font only decode it once.
+
+    Args:
+        subtitles_path (str): Path to the .ass subtitles file.
+
+    Returns:
+        str: Directory containing the extracted font.
     """
-    with open(subtitles_path, "r") as file:
-        subtitle_content = file.read()
-    
-    font_match = re.search(r"data: (.+)", subtitle_content)
+    # Scanned line by line, so the rest of the file isn't read once the font is found
+    font_match = None
+    with open(subtitles_path, "rb") as file:
+        for line in file:
+            font_match = FONT_DATA_PATTERN.search(line)
+            if font_match:
+                break
+
     if not font_match:
         raise ValueError("No Base64 font data found in the subtitles file.")
-    
-    base64_font_data = font_match.group(1)
-    
-    with tempfile.NamedTemporaryFile(suffix=".ttf") as temp_font_file:
-        temp_font_file.write(base64.b64decode(base64_font_data))
-        temp_font_file.flush()  
-        
-        font_path = temp_font_file.name  
-
-        command = [
-            "ffmpeg", "-y", "-i", input_path,
-            "-vf", f"ass={subtitles_path}:fontsdir={os.path.dirname(font_path)}",
-            "-c:v", "libx264",
-            "-crf", "18",
-            output_path
-        ]
-        
-        result = subprocess.run(
-            command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            check=True,  
-            text=True  
-        )
-        
-        if result.returncode != 0:
-            raise RuntimeError(f"Error attaching subtitles:: {result.stderr}")
-            
-            
\ No newline at end of file
+
+    base64_font_data = font_match.group(1).rstrip(b"\r")
+
+    fonts_dir = os.path.join(FONTS_CACHE_DIR, hashlib.sha1(base64_font_data).hexdigest())
+    font_path = os.path.join(fonts_dir, "font.ttf")
+    if os.path.exists(font_path):
+        return fonts_dir
+
+    # Written next to its final path and renamed, so concurrent jobs never see a partial font
+    os.makedirs(fonts_dir, exist_ok=True)
+    fd, temp_font_path = tempfile.mkstemp(dir=fonts_dir, suffix=".tmp")
+    with os.fdopen(fd, "wb") as font_file:
+        font_file.write(base64.b64decode(base64_font_data))
+    os.replace(temp_font_path, font_path)
+
+    return fonts_dir
+
+def subtitles_filter(subtitles_path: str, fonts_dir: str) -> str:
+    """
+    Builds the filter burning the .ass subtitles in, using the fonts from fonts_dir.
+    """
+    return f"ass={subtitles_path}:fontsdir={fonts_dir}"